@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
 import boto3
 import time
-import csv
 import os
-import subprocess
 import argparse
+import atexit
 import random
+import threading
+import concurrent.futures
+import json
+import functools
+import http.client
+import mmap
+import struct
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 from datetime import datetime
 
 import warnings
@@ -13,113 +21,482 @@ warnings.filterwarnings("ignore", category=DeprecationWarning, module="boto3")
 warnings.filterwarnings("ignore", category=DeprecationWarning, module="botocore")
 warnings.filterwarnings("ignore", message=".*Boto3 will no longer support Python.*")
 
+# Size of each write issued while filling the benchmark file
+WRITE_CHUNK_SIZE = 64 << 20
+# Granularity at which EBS snapshots track changed data
+EBS_BLOCK_SIZE = 512 << 10
+# Size of each write issued when rewriting part of the benchmark file
+DELTA_BLOCK_SIZE = 1 << 20
+
+# EBS allows at most 5 snapshots of the same volume in progress at once
+MAX_CONCURRENT_SNAPSHOTS = 5
+# Attempts at creating a snapshot while EBS throttles the volume
+SNAPSHOT_CREATE_ATTEMPTS = 6
+# Name prefix of the per-run EventBridge rule and SQS queue delivering snapshot notifications
+SNAPSHOT_EVENTS_NAME = 'aws-snapshot-profiler-snapshots'
+# Seconds between direct snapshot state checks while waiting for its notification
+SNAPSHOT_EVENT_CHECK_INTERVAL = 60
+# Seconds between snapshot state checks, how many checks to make, and how long
+# the snapshot progress may stay unchanged before giving up
+SNAPSHOT_POLL_INTERVAL = 10
+SNAPSHOT_POLL_ATTEMPTS = 360
+SNAPSHOT_STALL_TIMEOUT = 600
+# Seconds any snapshot may take, however its completion is detected
+SNAPSHOT_WAIT_TIMEOUT = SNAPSHOT_POLL_ATTEMPTS * SNAPSHOT_POLL_INTERVAL
+# Seconds between AMI state checks, and how many checks to make
+IMAGE_POLL_INTERVAL = 2
+IMAGE_POLL_ATTEMPTS = 150
+# Address of the EC2 instance metadata service
+IMDS_HOST = '169.254.169.254'
+# Configuration shared by all AWS clients, pooling keep-alive connections
+CLIENT_CONFIG = Config(
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    max_pool_connections=64,
+    tcp_keepalive=True
+)
+
+# Process ID making the benchmark file name unique
+_PID = os.getpid()
+# Descriptors of the result CSV files kept open for the whole run, keyed by filename
+_csv_fds = {}
+# Held while creating clients, as sessions must not be used from several threads
+_session_lock = threading.Lock()
+# Snapshots waited for, and the notifications received for them, keyed by snapshot ID
+_awaited_snapshots = set()
+_snapshot_events = {}
+# Guards the two above, and is notified whenever notifications were filed
+_snapshot_events_cond = threading.Condition()
+# Whether a thread is receiving notifications on behalf of all waiting ones
+_snapshot_events_receiving = False
+# Enables fast snapshot restore off the snapshot workers' critical path
+_fsr_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+atexit.register(_fsr_executor.shutdown, wait=True)
+
+@functools.lru_cache(maxsize=1)
+def _session():
+    """Return the boto3 session shared by the whole run"""
+    return boto3.session.Session()
+
+@functools.lru_cache(maxsize=None)
+def _client(service_name):
+    """Return the client for an AWS service, shared by all threads"""
+    with _session_lock:
+        return _session().client(service_name, config=CLIENT_CONFIG)
+
+def _ec2_client():
+    """Return the shared EC2 client"""
+    return _client('ec2')
+
+@functools.lru_cache(maxsize=1)
+def _current_region():
+    """Return the region the benchmark runs in"""
+    return _session().region_name
+
+def _open_direct(filename, truncate=True):
+    """Open a file for writing, bypassing the page cache where supported"""
+    flags = os.O_WRONLY | os.O_CREAT | (os.O_TRUNC if truncate else 0)
+    try:
+        return os.open(filename, flags | os.O_DIRECT, 0o644)
+    except OSError:
+        # Some filesystems, e.g. tmpfs, do not support direct I/O
+        return os.open(filename, flags, 0o644)
+
+def _write_random_blocks(fd, offsets, block_size):
+    """Write distinct random blocks of block_size bytes at the given offsets"""
+    # Anonymous mappings are page-aligned, as O_DIRECT requires
+    with mmap.mmap(-1, block_size) as buf, memoryview(buf) as view:
+        # Random data is only generated once; stamping each EBS block with
+        # its offset keeps all blocks of the file distinct
+        view[:] = os.urandom(block_size)
+        for offset in offsets:
+            for block in range(0, block_size, EBS_BLOCK_SIZE):
+                struct.pack_into('<Q', view, block, offset + block)
+            os.pwrite(fd, view, offset)
+    # Make sure the data reached the volume before it gets snapshotted
+    os.fsync(fd)
+
 def create_random_file(size_gb, directory="/tmp"):
-    """Create file with random content and random name"""
-    random_num = random.randint(10000, 99999)
-    filename = f"{directory}/aws-snapshot-profiler-{random_num}.dat"
-    size_mb = size_gb * 1024
+    """Create file with random content and a name unique to this process"""
+    filename = f"{directory}/aws-snapshot-profiler-{_PID}.dat"
+    size_bytes = size_gb << 30
 
     print(f"Creating {size_gb}GB random file: {filename}")
-    subprocess.run(['dd', 'if=/dev/urandom', f'of={filename}', 'bs=1M', f'count={size_mb}'], check=True)
+    fd = _open_direct(filename)
+    try:
+        # Allocate all extents up front, then dirty every EBS block in large writes
+        if size_bytes:
+            os.posix_fallocate(fd, 0, size_bytes)
+        _write_random_blocks(fd, range(0, size_bytes, WRITE_CHUNK_SIZE), WRITE_CHUNK_SIZE)
+    finally:
+        os.close(fd)
     print(f"File {filename} created successfully")
     return filename
 
-def get_instance_metadata():
-    """Get current instance and volume info"""
-    ec2 = boto3.client('ec2')
+def dirty_random_file(filename, size_gb, delta_pct):
+    """Rewrite a random share of the blocks of a file made by create_random_file"""
+    size_bytes = size_gb << 30
+    # The whole file is rewritten in large sequential chunks
+    block_size = WRITE_CHUNK_SIZE if delta_pct >= 100 else DELTA_BLOCK_SIZE
+    num_blocks = size_bytes // block_size
+    blocks = random.sample(range(num_blocks), num_blocks * delta_pct // 100)
+
+    print(f"Rewriting {delta_pct}% of {filename}")
+    fd = _open_direct(filename, truncate=False)
+    try:
+        _write_random_blocks(fd, sorted(block * block_size for block in blocks), block_size)
+    finally:
+        os.close(fd)
+    print(f"File {filename} rewritten successfully")
 
+def get_instance_id():
+    """Get current instance ID from the instance metadata service"""
     # Get instance ID from metadata (try IMDSv2 first, then IMDSv1)
     try:
-        # Try IMDSv2
-        token_result = subprocess.run(['curl', '-X', 'PUT', '-H', 'X-aws-ec2-metadata-token-ttl-seconds: 21600',
-                                     'http://169.254.169.254/latest/api/token'],
-                                    capture_output=True, text=True, timeout=5)
-        if token_result.returncode == 0 and token_result.stdout.strip():
-            token = token_result.stdout.strip()
-            result = subprocess.run(['curl', '-H', f'X-aws-ec2-metadata-token: {token}',
-                                   'http://169.254.169.254/latest/meta-data/instance-id'],
-                                  capture_output=True, text=True, timeout=5)
-        else:
-            # Fallback to IMDSv1
-            result = subprocess.run(['curl', '-s', '--connect-timeout', '5',
-                                   'http://169.254.169.254/latest/meta-data/instance-id'],
-                                  capture_output=True, text=True, timeout=5)
-
-        if result.returncode != 0 or not result.stdout.strip():
+        # Both requests go over the same keep-alive connection
+        conn = http.client.HTTPConnection(IMDS_HOST, 80, timeout=5)
+        try:
+            # Try IMDSv2
+            conn.request('PUT', '/latest/api/token', headers={'X-aws-ec2-metadata-token-ttl-seconds': '21600'})
+            response = conn.getresponse()
+            token = response.read().decode().strip()
+            if response.status == 200 and token:
+                headers = {'X-aws-ec2-metadata-token': token}
+            else:
+                # Fallback to IMDSv1
+                headers = {}
+
+            conn.request('GET', '/latest/meta-data/instance-id', headers=headers)
+            response = conn.getresponse()
+            instance_id = response.read().decode().strip()
+        finally:
+            conn.close()
+
+        if response.status != 200 or not instance_id:
             raise Exception("Failed to retrieve instance ID from metadata service")
 
-        instance_id = result.stdout.strip()
-
     except Exception as e:
         raise Exception(f"Failed to get instance metadata. Ensure script runs on EC2 instance: {e}")
 
-    # Get root volume ID
-    response = ec2.describe_instances(InstanceIds=[instance_id])
-    volume_id = response['Reservations'][0]['Instances'][0]['BlockDeviceMappings'][0]['Ebs']['VolumeId']
+    return instance_id
 
-    return instance_id, volume_id
+def get_root_volume(instance_id):
+    """Get root volume ID of an instance"""
+    response = _ec2_client().describe_instances(InstanceIds=[instance_id])
+    return response['Reservations'][0]['Instances'][0]['BlockDeviceMappings'][0]['Ebs']['VolumeId']
 
-def create_snapshot_and_measure(volume_id, snapshot_num, filename):
-    """Create snapshot and measure time"""
-    ec2 = boto3.client('ec2')
-    
-    # Extract filename without path and extension for snapshot name
-    snapshot_name = os.path.basename(filename).replace('.dat', '')
+def prepare_snapshots(instance_id):
+    """Look up the root volume and set up its notifications, returning (volume ID, queue URL)"""
+    # The queue URL is None when snapshots must be polled instead
+    volume_id = get_root_volume(instance_id)
 
-    print(f"Starting snapshot {snapshot_num}...")
-    start_time = time.time()
-
-    response = ec2.create_snapshot(
-        VolumeId=volume_id,
-        Description=f'{snapshot_name} - Benchmark snapshot {snapshot_num}',
-        TagSpecifications=[
-            {
-                'ResourceType': 'snapshot',
-                'Tags': [
+    # Get snapshot completions pushed through EventBridge instead of polling
+    try:
+        queue_url = setup_snapshot_events(instance_id, volume_id)
+    except (BotoCoreError, ClientError) as e:
+        print(f"Warning: Could not set up snapshot notifications, polling instead: {e}")
+        queue_url = None
+
+    return volume_id, queue_url
+
+def setup_snapshot_events(instance_id, volume_id):
+    """Route snapshot notifications of a volume to an SQS queue and return its URL"""
+    sqs = _client('sqs')
+    events = _client('events')
+    # Each run gets its own rule and queue, deleted again at exit
+    name = f'{SNAPSHOT_EVENTS_NAME}-{instance_id}-{_PID}'
+
+    queue_url = sqs.create_queue(
+        QueueName=name,
+        Attributes={'MessageRetentionPeriod': '3600'}
+    )['QueueUrl']
+    atexit.register(teardown_snapshot_events, name, queue_url)
+    queue_arn = sqs.get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=['QueueArn']
+    )['Attributes']['QueueArn']
+
+    # The volume is given as arn:aws:ec2::<region>:volume/<volume-id>
+    rule_arn = events.put_rule(
+        Name=name,
+        EventPattern=json.dumps({
+            'source': ['aws.ec2'],
+            'detail-type': ['EBS Snapshot Notification'],
+            'detail': {
+                'event': ['createSnapshot'],
+                'source': [{'suffix': f':volume/{volume_id}'}]
+            }
+        })
+    )['RuleArn']
+
+    # Allow the rule, and only the rule, to deliver to the queue
+    sqs.set_queue_attributes(
+        QueueUrl=queue_url,
+        Attributes={
+            'Policy': json.dumps({
+                'Version': '2012-10-17',
+                'Statement': [
                     {
-                        'Key': 'Name',
-                        'Value': f'{snapshot_name} - Benchmark snapshot {snapshot_num}'
+                        'Effect': 'Allow',
+                        'Principal': {'Service': 'events.amazonaws.com'},
+                        'Action': 'sqs:SendMessage',
+                        'Resource': queue_arn,
+                        'Condition': {'ArnEquals': {'aws:SourceArn': rule_arn}}
                     }
                 ]
-            }
-        ]
+            })
+        }
+    )
+    events.put_targets(
+        Rule=name,
+        Targets=[{'Id': name, 'Arn': queue_arn}]
     )
-    snapshot_id = response['SnapshotId']
 
-    # Wait for snapshot completion
-    waiter = ec2.get_waiter('snapshot_completed')
-    waiter.wait(SnapshotIds=[snapshot_id])
+    return queue_url
 
-    end_time = time.time()
-    elapsed_time = end_time - start_time
+def teardown_snapshot_events(name, queue_url):
+    """Delete the rule and queue made by setup_snapshot_events"""
+    events = _client('events')
+    sqs = _client('sqs')
 
-    # Enable fast snapshot restore
     try:
-        current_region = boto3.Session().region_name
-        ec2.enable_fast_snapshot_restores(
-            AvailabilityZones=[f"{current_region}a"],
+        events.remove_targets(Rule=name, Ids=[name])
+        events.delete_rule(Name=name)
+    except (BotoCoreError, ClientError) as e:
+        print(f"Warning: Could not delete EventBridge rule {name}: {e}")
+    try:
+        sqs.delete_queue(QueueUrl=queue_url)
+    except (BotoCoreError, ClientError) as e:
+        print(f"Warning: Could not delete SQS queue {queue_url}: {e}")
+
+def _receive_snapshot_events(queue_url):
+    """Move pending snapshot notifications from the queue to _snapshot_events"""
+    sqs = _client('sqs')
+
+    response = sqs.receive_message(QueueUrl=queue_url, WaitTimeSeconds=20, MaxNumberOfMessages=10)
+    messages = response.get('Messages', [])
+    with _snapshot_events_cond:
+        for message in messages:
+            detail = json.loads(message['Body']).get('detail', {})
+            # The snapshot is given as arn:aws:ec2::<region>:snapshot/<snapshot-id>
+            snapshot_id = detail.get('snapshot_id', '').rsplit('/', 1)[-1]
+            if snapshot_id in _awaited_snapshots:
+                _snapshot_events[snapshot_id] = detail
+        _snapshot_events_cond.notify_all()
+
+    for message in messages:
+        sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+
+def _check_snapshot_state(snapshot_id, last_seen):
+    """Return whether a snapshot completed, raising if it failed or stalled"""
+    # `last_seen` holds the last reported progress and when it changed
+    snapshot = _ec2_client().describe_snapshots(SnapshotIds=[snapshot_id])['Snapshots'][0]
+    if snapshot['State'] == 'completed':
+        return True
+    if snapshot['State'] == 'error':
+        raise Exception(f"Snapshot {snapshot_id} failed: {snapshot.get('StateMessage')}")
+
+    progress = snapshot.get('Progress')
+    if progress != last_seen.get('progress'):
+        last_seen.update(progress=progress, changed=time.time())
+    elif time.time() - last_seen['changed'] > SNAPSHOT_STALL_TIMEOUT:
+        raise Exception(f"Snapshot {snapshot_id} stuck at {progress} for {SNAPSHOT_STALL_TIMEOUT} seconds")
+    return False
+
+def _new_snapshot_tracking():
+    """Return the initial `last_seen` state of _check_snapshot_state"""
+    return {'progress': None, 'changed': time.time()}
+
+def wait_for_snapshot_event(queue_url, snapshot_id):
+    """Wait for a snapshot to complete, returning False if the queue failed"""
+    global _snapshot_events_receiving
+
+    with _snapshot_events_cond:
+        _awaited_snapshots.add(snapshot_id)
+    # Also check the snapshot directly, in case its notification never arrives
+    next_check = time.time() + SNAPSHOT_EVENT_CHECK_INTERVAL
+    deadline = time.time() + SNAPSHOT_WAIT_TIMEOUT
+    last_seen = _new_snapshot_tracking()
+
+    try:
+        while True:
+            with _snapshot_events_cond:
+                # Only one thread polls the queue, the others wait for what it files
+                while (snapshot_id not in _snapshot_events and _snapshot_events_receiving
+                       and time.time() < next_check):
+                    _snapshot_events_cond.wait(next_check - time.time())
+                if snapshot_id in _snapshot_events:
+                    detail = _snapshot_events.pop(snapshot_id)
+                    break
+                receiving = not _snapshot_events_receiving
+                _snapshot_events_receiving = True
+
+            if receiving:
+                try:
+                    _receive_snapshot_events(queue_url)
+                finally:
+                    # Let a waiting thread take over polling if this one is done
+                    with _snapshot_events_cond:
+                        _snapshot_events_receiving = False
+                        _snapshot_events_cond.notify_all()
+
+            if time.time() >= next_check:
+                try:
+                    if _check_snapshot_state(snapshot_id, last_seen):
+                        return True
+                except (BotoCoreError, ClientError) as e:
+                    # The queue still works, so keep waiting on it
+                    print(f"Warning: Could not check snapshot {snapshot_id}: {e}")
+                if time.time() > deadline:
+                    raise Exception(f"Snapshot {snapshot_id} not completed after {SNAPSHOT_WAIT_TIMEOUT} seconds")
+                next_check = time.time() + SNAPSHOT_EVENT_CHECK_INTERVAL
+    except (BotoCoreError, ClientError) as e:
+        print(f"Warning: Could not receive snapshot notifications: {e}")
+        return False
+    finally:
+        with _snapshot_events_cond:
+            _awaited_snapshots.discard(snapshot_id)
+
+    if detail.get('result') != 'succeeded':
+        raise Exception(f"Snapshot {snapshot_id} failed: {detail.get('cause')}")
+    return True
+
+def wait_for_snapshot(snapshot_id):
+    """Poll a snapshot until it completes, giving up if its progress stalls"""
+    last_seen = _new_snapshot_tracking()
+
+    for _ in range(SNAPSHOT_POLL_ATTEMPTS):
+        if _check_snapshot_state(snapshot_id, last_seen):
+            return
+        time.sleep(SNAPSHOT_POLL_INTERVAL)
+
+    raise Exception(f"Snapshot {snapshot_id} not completed after {SNAPSHOT_WAIT_TIMEOUT} seconds")
+
+def _enable_fsr_safely(snapshot_id, region):
+    """Enable fast snapshot restore, only warning on failure"""
+    try:
+        _ec2_client().enable_fast_snapshot_restores(
+            AvailabilityZones=[f"{region}a"],
             SourceSnapshotIds=[snapshot_id]
         )
         print(f"Fast snapshot restore enabled for {snapshot_id}")
     except Exception as e:
         print(f"Warning: Could not enable fast snapshot restore: {e}")
 
+def create_snapshot_and_measure(volume_id, snapshot_num, filename, started=None, queue_url=None):
+    """Create snapshot and measure time, setting `started` once it was requested"""
+    try:
+        ec2 = _ec2_client()
+
+        # Extract filename without path and extension for snapshot name
+        snapshot_name = os.path.basename(filename).replace('.dat', '')
+
+        print(f"Starting snapshot {snapshot_num}...")
+
+        for attempt in range(SNAPSHOT_CREATE_ATTEMPTS):
+            start_time = time.time()
+            try:
+                response = ec2.create_snapshot(
+                    VolumeId=volume_id,
+                    Description=f'{snapshot_name} - Benchmark snapshot {snapshot_num}',
+                    TagSpecifications=[
+                        {
+                            'ResourceType': 'snapshot',
+                            'Tags': [
+                                {
+                                    'Key': 'Name',
+                                    'Value': f'{snapshot_name} - Benchmark snapshot {snapshot_num}'
+                                }
+                            ]
+                        }
+                    ]
+                )
+                break
+            except ClientError as e:
+                if (e.response['Error']['Code'] != 'SnapshotCreationPerVolumeRateExceeded'
+                        or attempt == SNAPSHOT_CREATE_ATTEMPTS - 1):
+                    raise
+                print(f"Snapshot {snapshot_num} throttled, retrying in {2 ** attempt} seconds")
+                time.sleep(2 ** attempt)
+    finally:
+        if started is not None:
+            started.set()
+    snapshot_id = response['SnapshotId']
+
+    # Wait for snapshot completion, polling only if notifications cannot be received
+    if queue_url is None or not wait_for_snapshot_event(queue_url, snapshot_id):
+        wait_for_snapshot(snapshot_id)
+
+    end_time = time.time()
+    elapsed_time = end_time - start_time
+
+    # Enable fast snapshot restore in the background
+    _fsr_executor.submit(_enable_fsr_safely, snapshot_id, _current_region())
+
     print(f"Snapshot {snapshot_id} ({snapshot_name}) completed in {elapsed_time:.2f} seconds")
     return snapshot_id, elapsed_time
 
+def _csv_fd(csv_filename, header):
+    """Return a descriptor on a CSV file kept open for the whole run"""
+    if csv_filename not in _csv_fds:
+        fd = os.open(csv_filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if os.fstat(fd).st_size == 0:
+            os.write(fd, header)
+        _csv_fds[csv_filename] = fd
+    return _csv_fds[csv_filename]
+
+def _close_csv_files():
+    """Close all CSV files opened by the recorders"""
+    for fd in _csv_fds.values():
+        os.close(fd)
+    _csv_fds.clear()
+
+atexit.register(_close_csv_files)
+
 def record_to_csv(snapshot_num, elapsed_time, csv_filename):
     """Record results to CSV"""
-    file_exists = os.path.exists(csv_filename)
-
-    with open(csv_filename, 'a', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        if not file_exists:
-            writer.writerow(['snapshot_number', 'elapsed_time'])
-        writer.writerow([snapshot_num, elapsed_time])
+    fd = _csv_fd(csv_filename, b'snapshot_number,elapsed_time\n')
+    # Fields never need quoting, so each row is a single unbuffered write
+    os.write(fd, f'{snapshot_num},{elapsed_time:.6f}\n'.encode())
+
+def wait_for_image(ami_id):
+    """Poll an AMI until it is available"""
+    ec2 = _ec2_client()
+
+    for _ in range(IMAGE_POLL_ATTEMPTS):
+        try:
+            images = ec2.describe_images(ImageIds=[ami_id])['Images']
+        except ClientError as e:
+            # A freshly registered AMI may not be visible yet
+            if e.response['Error']['Code'] != 'InvalidAMIID.NotFound':
+                raise
+            images = []
+
+        state = images[0]['State'] if images else 'pending'
+        if state == 'available':
+            return
+        if state in ('failed', 'error', 'invalid', 'deregistered'):
+            raise Exception(f"AMI {ami_id} entered state {state}")
+        time.sleep(IMAGE_POLL_INTERVAL)
+
+    raise Exception(f"AMI {ami_id} not available after {IMAGE_POLL_ATTEMPTS * IMAGE_POLL_INTERVAL} seconds")
+
+def record_finished_snapshots(snapshots, csv_filename, block=False):
+    """Record finished snapshots to CSV in snapshot order, returning (number, ID) pairs"""
+    # `snapshots` maps pending futures to snapshot numbers; recorded ones are removed
+    if block:
+        concurrent.futures.wait(snapshots, return_when=concurrent.futures.FIRST_COMPLETED)
+
+    recorded = []
+    for future in sorted((f for f in snapshots if f.done()), key=snapshots.get):
+        snapshot_num = snapshots.pop(future)
+        snapshot_id, elapsed_time = future.result()
+        record_to_csv(snapshot_num, elapsed_time, csv_filename)
+        recorded.append((snapshot_num, snapshot_id))
+    return recorded
 
 def create_ami_and_measure(snapshot_id, snapshot_name):
     """Create AMI from snapshot and measure time"""
-    ec2 = boto3.client('ec2')
+    ec2 = _ec2_client()
     
     print(f"Creating AMI from snapshot {snapshot_id}...")
     start_time = time.time()
@@ -151,8 +528,7 @@ def create_ami_and_measure(snapshot_id, snapshot_name):
     ami_id = ami_response['ImageId']
     
     # Wait for AMI to be available
-    waiter = ec2.get_waiter('image_available')
-    waiter.wait(ImageIds=[ami_id])
+    wait_for_image(ami_id)
     
     end_time = time.time()
     elapsed_time = end_time - start_time
@@ -162,13 +538,8 @@ def create_ami_and_measure(snapshot_id, snapshot_name):
 
 def record_ami_to_csv(ami_id, elapsed_time, csv_filename):
     """Record AMI creation results to CSV"""
-    file_exists = os.path.exists(csv_filename)
-
-    with open(csv_filename, 'a', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        if not file_exists:
-            writer.writerow(['ami_id', 'elapsed_time'])
-        writer.writerow([ami_id, elapsed_time])
+    fd = _csv_fd(csv_filename, b'ami_id,elapsed_time\n')
+    os.write(fd, f'{ami_id},{elapsed_time:.6f}\n'.encode())
 
 def main():
     parser = argparse.ArgumentParser(description='AWS EBS Snapshot Benchmark Tool')
@@ -177,30 +548,56 @@ def main():
     parser.add_argument('-s', '--size', type=int, default=10, help='File size in GB (default: 10)')
     parser.add_argument('-d', '--directory', default='/tmp', help='Directory for .dat files (default: /tmp)')
     parser.add_argument('-a', '--ami-csv', default='ami_results.csv', help='AMI creation CSV filename (default: ami_results.csv)')
+    parser.add_argument('-c', '--concurrency', type=int, default=MAX_CONCURRENT_SNAPSHOTS,
+                        help=f'Maximum number of snapshots in progress at once (default: {MAX_CONCURRENT_SNAPSHOTS})')
+    parser.add_argument('-p', '--delta-pct', type=int, default=100,
+                        help='Percentage of the file rewritten before each snapshot after the first (default: 100)')
     args = parser.parse_args()
+    concurrency = max(1, min(args.concurrency, MAX_CONCURRENT_SNAPSHOTS))
+    delta_pct = max(0, min(args.delta_pct, 100))
 
     try:
-        # Get instance info
-        instance_id, volume_id = get_instance_metadata()
-        current_region = boto3.Session().region_name
-
         last_snapshot_id = None
-        last_snapshot_name = None
-
-        # Create snapshots in loop
-        for snapshot_num in range(1, args.num_snapshots + 1):
-            # Step 1: Create random file for each snapshot
-            filename = create_random_file(args.size, args.directory)
-
-            # Step 2 & 3: Create snapshot and measure time
-            snapshot_id, elapsed_time = create_snapshot_and_measure(volume_id, snapshot_num, filename)
-            
-            # Store last snapshot info
-            last_snapshot_id = snapshot_id
-            last_snapshot_name = os.path.basename(filename).replace('.dat', '')
-
-            # Step 4: Record to CSV
-            record_to_csv(snapshot_num, elapsed_time, args.output)
+        snapshots = {}
+        recorded = []
+        filename = None
+
+        # Get instance ID first, so that running off EC2 fails before any data is written
+        instance_id = get_instance_id()
+
+        # Create snapshots in loop, letting up to `concurrency` of them run at once
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # Get volume info and set up snapshot notifications while the first file is written
+            preparation = executor.submit(prepare_snapshots, instance_id)
+
+            for snapshot_num in range(1, args.num_snapshots + 1):
+                # Step 1: Create random file, then rewrite part of it for each further snapshot
+                if filename is None:
+                    filename = create_random_file(args.size, args.directory)
+                    volume_id, queue_url = preparation.result()
+                else:
+                    dirty_random_file(filename, args.size, delta_pct)
+
+                # Step 2 & 3: Create snapshot and measure time
+                started = threading.Event()
+                future = executor.submit(create_snapshot_and_measure, volume_id, snapshot_num, filename,
+                                         started, queue_url)
+                snapshots[future] = snapshot_num
+
+                # The file must not be rewritten before this snapshot has started
+                started.wait()
+
+                # Step 4: Record to CSV the snapshots completed so far
+                recorded += record_finished_snapshots(snapshots, args.output)
+
+            while snapshots:
+                recorded += record_finished_snapshots(snapshots, args.output, block=True)
+
+        # Store last snapshot info
+        for snapshot_num, snapshot_id in recorded:
+            if snapshot_num == args.num_snapshots:
+                last_snapshot_id = snapshot_id
+                last_snapshot_name = os.path.basename(filename).replace('.dat', '')
 
         # Step 5: Create AMI from last snapshot
         if last_snapshot_id: